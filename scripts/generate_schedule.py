@@ -1,22 +1,30 @@
 # \scripts\generate_schedule.py
 # pylint: disable=invalid-name, broad-except, logging-fstring-interpolation
 
+import hashlib
 import json
 import sys
 import traceback
+from bisect import bisect_left, bisect_right
 from pathlib import Path
 from collections import defaultdict
-from typing import List, Dict, Any, Tuple, DefaultDict  # Added type hints
+from typing import List, Dict, Any, Iterable, Set, Tuple, DefaultDict  # Added type hints
 
 # Third-party imports (adjust based on actual client if needed)
 from postgrest.exceptions import APIError
 from httpx import RequestError
 
+# Optional native JSON serializer — stdlib json stays as the fallback.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Local imports
 from db_connection import get_supabase_client
 
 # --- Constants ---
-DAYS_OF_WEEK = [
+DAYS_OF_WEEK = (
     "Monday",
     "Tuesday",
     "Wednesday",
@@ -24,8 +32,8 @@ DAYS_OF_WEEK = [
     "Friday",
     "Saturday",
     "Sunday",
-]
-TIME_SLOTS = [
+)
+TIME_SLOTS = (
     "08:30",
     "09:00",
     "09:30",
@@ -55,7 +63,15 @@ TIME_SLOTS = [
     "21:30",
     "22:00",
     "22:30",
-]
+)
+# Slot boundaries as minutes since midnight — timings are converted to ints at
+# ingest so the overlap math compares integers instead of "HH:MM" strings.
+TIME_SLOTS_MIN = tuple(int(t[:2]) * 60 + int(t[3:]) for t in TIME_SLOTS)
+# One availability bit per half-hour slot between consecutive TIME_SLOTS entries.
+SLOT_COUNT = len(TIME_SLOTS) - 1
+FULL_MASK = (1 << SLOT_COUNT) - 1
+# Template row for rooms with no bookings on a given day (copied per room).
+ALL_AVAILABLE = [1] * SLOT_COUNT
 # Mapping of combined rooms to their individual components.
 # Rule:
 # - If a combined room is busy, both individual rooms are busy.
@@ -83,7 +99,15 @@ except Exception as init_err:
 # --- Functions ---
 
 RoomInfo = Dict[str, str]
-TimingsDict = DefaultDict[str, DefaultDict[str, List[Tuple[str, str]]]]
+TimingsDict = DefaultDict[Tuple[str, str], Set[Tuple[int, int]]]
+# Shared immutable fallback for (day, room) lookups with no timings.
+EMPTY_TIMINGS: frozenset = frozenset()
+
+
+def to_minutes(hhmm: str) -> int:
+    """Converts an "HH:MM" (or "H:MM") string to minutes since midnight."""
+    hours, minutes = hhmm.split(":", 1)
+    return int(hours) * 60 + int(minutes)
 
 
 def fetch_rooms_data_paginated(page_size=100) -> List[RoomInfo]:
@@ -92,25 +116,30 @@ def fetch_rooms_data_paginated(page_size=100) -> List[RoomInfo]:
     """
     print(f"Fetching rooms data from Supabase with pagination (page size={page_size})...")
     rooms_info: List[RoomInfo] = []
-    offset = 0
+    # Keyset pagination on the ordered Name column: each page seeks past the
+    # last seen key instead of making the server re-scan an ever-growing
+    # OFFSET prefix.
+    last_name = ""
     while True:
         try:
-            response = (
+            query = (
                 supabase.table("Rooms")
                 .select("ShortCode, Name")
                 .neq("Name", "Consultation")
                 .neq("Name", "Online")
                 .order("Name", desc=False)
-                .range(offset, offset + page_size - 1)
-                .execute()
+                .limit(page_size)
             )
+            if last_name:
+                query = query.gt("Name", last_name)
+            response = query.execute()
             if response.data:
                 for room in response.data:
                     if room.get("ShortCode") and room.get("Name"):
                         rooms_info.append({"short_code": room["ShortCode"], "full_name": room["Name"]})
                 if len(response.data) < page_size:
                     break
-                offset += page_size
+                last_name = response.data[-1]["Name"]
             else:
                 break
         except (APIError, RequestError) as db_err:
@@ -124,20 +153,72 @@ def fetch_rooms_data_paginated(page_size=100) -> List[RoomInfo]:
     return rooms_info
 
 
+def fetch_all_timings_bulk() -> TimingsDict:
+    """
+    Fetches all timings from Supabase in a single CSV request. PostgREST streams
+    the whole table as text/csv, so one roundtrip replaces the 500-row JSON pages
+    (and their per-page JSON decode). Falls back to paginated JSON on any error.
+    """
+    print("Fetching all timings from Supabase as CSV (single request)...")
+    import csv
+    import io
+    timings_by_day: TimingsDict = defaultdict(set)
+    try:
+        response = (
+            supabase.table("Timings")
+            .select("Day, Room, StartTime, EndTime")
+            .csv()
+            .execute()
+        )
+        processed_count = 0
+        reader = csv.reader(io.StringIO(response.data or ""))
+        header = next(reader, None)
+        if not header:
+            raise ValueError("Empty CSV response for Timings.")
+        # Resolve column positions once; the row loop then unpacks positionally
+        # instead of doing four dict lookups per timing entry.
+        col = {name.strip(): idx for idx, name in enumerate(header)}
+        day_idx, room_idx = col["Day"], col["Room"]
+        start_idx, end_idx = col["StartTime"], col["EndTime"]
+        for row in reader:
+            day = row[day_idx]
+            full_room_name = row[room_idx]
+            start_time = row[start_idx]
+            end_time = row[end_idx]
+            if day and full_room_name and start_time and end_time:
+                timings_by_day[(day, full_room_name)].add(
+                    (to_minutes(start_time), to_minutes(end_time))
+                )
+                processed_count += 1
+        print(f"Fetched and processed {processed_count} valid timing entries.")
+        return timings_by_day
+    except (APIError, RequestError) as db_err:
+        print(f"Error fetching timings as CSV: {type(db_err).__name__} - {db_err}", file=sys.stderr)
+    except Exception as e:
+        print(f"Unexpected error fetching timings as CSV: {e}", file=sys.stderr)
+        traceback.print_exc()
+    print("Falling back to paginated JSON fetch...")
+    return fetch_all_timings_paginated()
+
+
 def fetch_all_timings_paginated(page_size=500) -> TimingsDict:
     """
-    Fetches all timings from Supabase in paginated fashion. Returns timings_by_day[day][full_room_name] = list of (start, end)
+    Fetches all timings from Supabase in paginated fashion. Returns
+    timings_by_day[(day, full_room_name)] = set of (start, end) minute pairs.
     """
     print(f"Fetching all timings from Supabase with pagination (page size={page_size})...")
-    timings_by_day: TimingsDict = defaultdict(lambda: defaultdict(list))
-    offset = 0
+    timings_by_day: TimingsDict = defaultdict(set)
+    # Keyset pagination on the primary key — see fetch_rooms_data_paginated.
+    last_id = -1
     processed_count = 0
     while True:
         try:
             response = (
                 supabase.table("Timings")
-                .select("Day, Room, StartTime, EndTime")
-                .range(offset, offset + page_size - 1)
+                .select("id, Day, Room, StartTime, EndTime")
+                .order("id", desc=False)
+                .gt("id", last_id)
+                .limit(page_size)
                 .execute()
             )
             if response.data:
@@ -147,11 +228,13 @@ def fetch_all_timings_paginated(page_size=500) -> TimingsDict:
                     start_time = timing.get("StartTime")
                     end_time = timing.get("EndTime")
                     if day and full_room_name and start_time and end_time:
-                        timings_by_day[day][full_room_name].append((start_time, end_time))
+                        timings_by_day[(day, full_room_name)].add(
+                            (to_minutes(start_time), to_minutes(end_time))
+                        )
                         processed_count += 1
                 if len(response.data) < page_size:
                     break
-                offset += page_size
+                last_id = response.data[-1]["id"]
             else:
                 break
         except (APIError, RequestError) as db_err:
@@ -165,16 +248,22 @@ def fetch_all_timings_paginated(page_size=500) -> TimingsDict:
     return timings_by_day
 
 
-def is_slot_available(
-    slot_start: str, slot_end: str, room_timings: List[Tuple[str, str]]
-) -> bool:
+def build_busy_mask(room_timings: Iterable[Tuple[int, int]]) -> int:
     """
-    Checks if a given time slot overlaps with any existing timings for a room.
+    Folds a room's booked intervals (minutes since midnight) into a single
+    bitmask over the slot grid (bit i set = slot i busy). Slot i covers
+    [TIME_SLOTS_MIN[i], TIME_SLOTS_MIN[i+1]), so an interval (start, end)
+    marks every slot with boundary[i] < end and boundary[i+1] > start. One
+    pass over the timings replaces the former per-slot rescan in
+    is_slot_available.
     """
+    mask = 0
     for timing_start, timing_end in room_timings:
-        if timing_start < slot_end and timing_end > slot_start:
-            return False
-    return True
+        lo = max(0, bisect_right(TIME_SLOTS_MIN, timing_start) - 1)
+        hi = min(SLOT_COUNT - 1, bisect_left(TIME_SLOTS_MIN, timing_end) - 1)
+        if hi >= lo:
+            mask |= ((1 << (hi - lo + 1)) - 1) << lo
+    return mask
 
 
 def generate_schedule_data_from_csv(csv_path: Path) -> List[Dict[str, Any]]:
@@ -184,46 +273,60 @@ def generate_schedule_data_from_csv(csv_path: Path) -> List[Dict[str, Any]]:
     print(f"Generating schedule data from CSV: {csv_path}")
     import csv
     schedule: List[Dict[str, Any]] = []
-    # Build: {day: {room: [(start, end), ...]}}
-    timings_by_day_room = defaultdict(lambda: defaultdict(list))
+    # Build: {(day, room): {(start, end), ...}} — one flat dict keyed by
+    # tuple, so the hot lookups below are a single hash probe.
+    # Sets de-duplicate repeated (start, end) pairs at ingest.
+    timings_by_day_room: TimingsDict = defaultdict(set)
     rooms_set = set()
     try:
         with csv_path.open("r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if not header:
+                raise ValueError("CSV file is empty.")
+            # Positional indexing per row is markedly cheaper than the
+            # per-row dict that csv.DictReader builds.
+            col = {name.strip(): idx for idx, name in enumerate(header)}
+            day_idx, room_idx = col["Day"], col["Room"]
+            start_idx, end_idx = col["StartTime"], col["EndTime"]
             for row in reader:
-                day = row.get("Day")
-                room = row.get("Room")
-                start = row.get("StartTime")
-                end = row.get("EndTime")
+                if len(row) <= max(day_idx, room_idx, start_idx, end_idx):
+                    continue
+                day = row[day_idx]
+                room = row[room_idx]
+                start = row[start_idx]
+                end = row[end_idx]
                 if day and room and start and end:
-                    timings_by_day_room[day][room].append((start, end))
+                    try:
+                        interval = (to_minutes(start), to_minutes(end))
+                    except ValueError:
+                        print(f"Warning: skipping row with malformed time: {row}")
+                        continue
+                    timings_by_day_room[(day, room)].add(interval)
                     rooms_set.add(room)
     except Exception as e:
         print(f"Error reading CSV: {e}. Falling back to Supabase.")
         # fallback to Supabase
         rooms_info = fetch_rooms_data_paginated()
-        timings_by_day_room = fetch_all_timings_paginated()
-        rooms_set = set()
-        for day in timings_by_day_room:
-            for room in timings_by_day_room[day]:
-                rooms_set.add(room)
+        timings_by_day_room = fetch_all_timings_bulk()
+        rooms_set = {room for _, room in timings_by_day_room}
 
-    # Helper to extract short code from full room name
-    def get_room_short_code(room_name: str) -> str:
-        """Extract short code (before first dash) from room name."""
-        return room_name.split("-")[0].strip() if "-" in room_name else room_name.strip()
+    # Short code = text before the first dash. Computed once per room here and
+    # looked up everywhere below instead of re-splitting the name each time.
+    room_to_shortcode: Dict[str, str] = {
+        room: room.split("-", 1)[0].strip() for room in rooms_set
+    }
 
     # Build a mapping from short code to full room names
     shortcode_to_rooms: Dict[str, List[str]] = defaultdict(list)
-    for room in rooms_set:
-        short_code = get_room_short_code(room)
+    for room, short_code in room_to_shortcode.items():
         shortcode_to_rooms[short_code].append(room)
 
     # Expand rooms_set to include mapped counterparts
     def expand_rooms_set(base_rooms: set) -> set:
         expanded = set(base_rooms)
-        base_shortcodes = {get_room_short_code(r) for r in base_rooms}
-        
+        base_shortcodes = {room_to_shortcode[r] for r in base_rooms}
+
         for combined_code, (ind_a_code, ind_b_code) in COMBINED_ROOM_MAP.items():
             # If combined room exists in data, add both individuals if they exist
             if combined_code in base_shortcodes:
@@ -236,18 +339,21 @@ def generate_schedule_data_from_csv(csv_path: Path) -> List[Dict[str, Any]]:
 
     rooms_set = expand_rooms_set(rooms_set)
 
+    # Weekly-repeating classes give many (day, room) cells identical masks;
+    # cache the expanded slot list per mask. Entries are shared, never
+    # mutated — they only feed the JSON serializer.
+    avail_cache: Dict[int, List[int]] = {}
+
     for day in DAYS_OF_WEEK:
-        print(f"Processing day: {day}")
         day_data: Dict[str, Any] = {"day": day, "rooms": []}
-        timings_for_day = dict(timings_by_day_room.get(day, {}))  # shallow copy
 
-        # Build effective timings for the day honoring combined/individual rules
-        effective_timings = defaultdict(list)
-        # Start with original timings
-        for room_name, intervals in timings_for_day.items():
-            # de-duplicate while preserving as list of tuples
-            unique = list({(s, e) for (s, e) in intervals})
-            effective_timings[room_name].extend(sorted(unique))
+        # Build effective timings for the day honoring combined/individual rules.
+        # Sets de-duplicate on insert and make the mapping-rule unions O(1) per
+        # interval instead of a linear membership scan per append.
+        effective_timings: DefaultDict[str, set] = defaultdict(set)
+        for (t_day, room_name), intervals in timings_by_day_room.items():
+            if t_day == day:
+                effective_timings[room_name].update(intervals)
 
         # Apply mapping rules using short codes to match full room names
         for combined_code, (ind_a_code, ind_b_code) in COMBINED_ROOM_MAP.items():
@@ -259,46 +365,43 @@ def generate_schedule_data_from_csv(csv_path: Path) -> List[Dict[str, Any]]:
             # Collect original busy intervals for each category
             orig_combined = []
             for room in combined_rooms:
-                orig_combined.extend(timings_for_day.get(room, []))
-            
+                orig_combined.extend(timings_by_day_room.get((day, room), EMPTY_TIMINGS))
+
             orig_a = []
             for room in ind_a_rooms:
-                orig_a.extend(timings_for_day.get(room, []))
-            
+                orig_a.extend(timings_by_day_room.get((day, room), EMPTY_TIMINGS))
+
             orig_b = []
             for room in ind_b_rooms:
-                orig_b.extend(timings_for_day.get(room, []))
+                orig_b.extend(timings_by_day_room.get((day, room), EMPTY_TIMINGS))
 
             # Rule: Combined becomes busy if EITHER individual is busy (union)
             union_intervals = set(orig_combined + orig_a + orig_b)
             for combined_room in combined_rooms:
-                for s, e in union_intervals:
-                    if (s, e) not in effective_timings[combined_room]:
-                        effective_timings[combined_room].append((s, e))
+                effective_timings[combined_room] |= union_intervals
 
             # Rule: Each individual inherits the combined's busy intervals
             combined_intervals = set(orig_combined)
             for ind_room in ind_a_rooms:
-                for s, e in combined_intervals:
-                    if (s, e) not in effective_timings[ind_room]:
-                        effective_timings[ind_room].append((s, e))
-            
+                effective_timings[ind_room] |= combined_intervals
+
             for ind_room in ind_b_rooms:
-                for s, e in combined_intervals:
-                    if (s, e) not in effective_timings[ind_room]:
-                        effective_timings[ind_room].append((s, e))
+                effective_timings[ind_room] |= combined_intervals
 
         # Now compute availability using effective_timings and the expanded rooms_set
         for room in sorted(rooms_set):
-            room_output_data = {"room": room, "availability": []}
-            timings_for_this_room = effective_timings.get(room, [])
-            slot_count = len(TIME_SLOTS)
-            for i in range(slot_count - 1):
-                start_time = TIME_SLOTS[i]
-                end_time = TIME_SLOTS[i + 1]
-                available = is_slot_available(start_time, end_time, timings_for_this_room)
-                room_output_data["availability"].append(1 if available else 0)
-            day_data["rooms"].append(room_output_data)
+            timings_for_this_room = effective_timings.get(room)
+            if not timings_for_this_room:
+                # Fast path: nothing booked in this room today (common on
+                # weekends) — skip the mask fold entirely.
+                availability = ALL_AVAILABLE.copy()
+            else:
+                avail_mask = ~build_busy_mask(timings_for_this_room) & FULL_MASK
+                availability = avail_cache.get(avail_mask)
+                if availability is None:
+                    availability = [(avail_mask >> i) & 1 for i in range(SLOT_COUNT)]
+                    avail_cache[avail_mask] = availability
+            day_data["rooms"].append({"room": room, "availability": availability})
         schedule.append(day_data)
     print("Schedule data generation complete.")
     return schedule
@@ -308,9 +411,29 @@ def save_schedule_to_json(schedule_data: List[Dict[str, Any]]) -> bool:
     """Saves the generated schedule data to a JSON file. Returns True on success."""
     print(f"Saving schedule data to JSON file: {OUTPUT_JSON_PATH}...")
     try:
+        # Compact output: the file is consumed by the app (and fetched from
+        # GitHub raw), never read by humans, so indentation is pure bloat.
+        if orjson is not None:
+            new_bytes = orjson.dumps(schedule_data)
+        else:
+            new_bytes = json.dumps(schedule_data, separators=(",", ":")).encode("utf-8")
+
+        # Hash-compare against the existing file and skip the write when
+        # nothing changed — keeps the mtime (and any downstream git commit
+        # step) quiet on no-op runs without a structural deep-compare.
+        if OUTPUT_JSON_PATH.is_file():
+            new_digest = hashlib.sha256(new_bytes).digest()
+            old_digest = hashlib.sha256(OUTPUT_JSON_PATH.read_bytes()).digest()
+            if new_digest == old_digest:
+                print("Schedule data unchanged; skipping write.")
+                return True
+
         OUTPUT_JSON_PATH.parent.mkdir(parents=True, exist_ok=True)
-        with OUTPUT_JSON_PATH.open("w", encoding="utf-8") as file:
-            json.dump(schedule_data, file, indent=2)
+        # Atomic replace via temp file in the same dir — a crashed run can
+        # never leave a truncated scheduleData.json behind.
+        tmp_path = OUTPUT_JSON_PATH.with_suffix(OUTPUT_JSON_PATH.suffix + ".tmp")
+        tmp_path.write_bytes(new_bytes)
+        tmp_path.replace(OUTPUT_JSON_PATH)
         print(f"Schedule data saved successfully to {OUTPUT_JSON_PATH.resolve()}")
         return True
     except (IOError, OSError) as file_err:
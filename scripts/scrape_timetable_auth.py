@@ -43,10 +43,12 @@ import csv
 import datetime
 import json
 import os
+import random
 import re
 import sys
 import time
 from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, Iterator, List, Optional, Tuple
 
@@ -56,6 +58,11 @@ from postgrest.exceptions import APIError
 
 from db_connection import get_supabase_client
 
+try:
+    import orjson  # optional: faster decode of the timetableData payload
+except ImportError:
+    orjson = None
+
 load_dotenv()
 load_dotenv(".env.local", override=True)
 
@@ -76,6 +83,14 @@ NAV_TIMEOUT_MS     = 60_000
 LOGIN_MAX_STEPS    = 25
 CF_SETTLE_SEC      = 6
 
+# Full-jitter backoff between backend attempts (AWS-style):
+# sleep = uniform(0, min(CAP, BASE * 2**attempt)).
+BACKOFF_BASE_SEC = 2.0
+BACKOFF_CAP_SEC  = 30.0
+
+# Inline JS assignment embedding the timetable payload in the viewer page.
+TIMETABLE_RE = re.compile(r"timetableData\s*=\s*(\[.*?\])\s*;", re.DOTALL)
+
 
 # ── Utilities ────────────────────────────────────────────────────────────────
 
@@ -102,14 +117,22 @@ def normalize_whitespace(text: Optional[str]) -> str:
     return " ".join(text.split())
 
 
+_HHMM_RE = re.compile(r"^(\d{1,2}):(\d{1,2})$")
+
+
+@lru_cache(maxsize=512)
 def format_time_hhmm(time_str: Optional[str]) -> str:
+    """Canonicalize portal times to zero-padded HH:MM; pass through anything else."""
     if not time_str:
         return ""
     norm = normalize_whitespace(time_str)
-    try:
-        return datetime.datetime.strptime(norm, "%H:%M").strftime("%H:%M")
-    except ValueError:
+    m = _HHMM_RE.match(norm)
+    if not m:
         return norm
+    hour, minute = int(m.group(1)), int(m.group(2))
+    if hour > 23 or minute > 59:
+        return norm
+    return f"{hour:02d}:{minute:02d}"
 
 
 def current_semester() -> str:
@@ -196,17 +219,16 @@ def fetch_room_mapping(supabase) -> Dict[str, str]:
         resp = (
             supabase.table("Rooms")
             .select("Name, ShortCode")
-            .neq("Name", "%Consultation%")
-            .neq("Name", "%Online%")
+            .not_.ilike("Name", "%Consultation%")
+            .not_.ilike("Name", "%Online%")
             .execute()
         )
-        raw: Dict[str, str] = {}
+        mapping: Dict[str, str] = {}
         for row in resp.data or []:
             sc = normalize_whitespace(row.get("ShortCode", ""))
             nm = normalize_whitespace(row.get("Name", ""))
             if sc and nm:
-                raw[sc] = nm
-        mapping = {k: raw[k] for k in sorted(raw, key=len, reverse=True)}
+                mapping[sc] = nm
         log("ROOMS", f"{len(mapping)} entries loaded.")
         return mapping
     except APIError as exc:
@@ -216,9 +238,17 @@ def fetch_room_mapping(supabase) -> Dict[str, str]:
     return {}
 
 
-def resolve_room(loc: str, mapping: Dict[str, str]) -> str:
-    for sc, name in mapping.items():
-        if loc.startswith(sc):
+def shortcode_lengths(mapping: Dict[str, str]) -> Tuple[int, ...]:
+    """Distinct shortcode lengths, longest first (for longest-prefix-wins)."""
+    return tuple(sorted({len(k) for k in mapping}, reverse=True))
+
+
+def resolve_room(loc: str, mapping: Dict[str, str], lengths: Tuple[int, ...]) -> str:
+    # Exact dict lookups per distinct shortcode length replace the old
+    # startswith scan over every entry; longest prefix still wins.
+    for n in lengths:
+        name = mapping.get(loc[:n])
+        if name is not None:
             return name
     return loc
 
@@ -239,13 +269,44 @@ def is_cloudflare_page(page) -> bool:
     return False
 
 
+def cf_settle(page, max_sec: float = CF_SETTLE_SEC) -> None:
+    """
+    Give a just-navigated page time to surface a Cloudflare interstitial.
+    Waits for the load event (challenge pages fire it too) instead of a
+    fixed sleep, so fast navigations don't burn the full max_sec.
+    """
+    try:
+        page.wait_for_load_state("load", timeout=int(max_sec * 1000))
+    except Exception:
+        pass
+
+
+# In-page mirror of is_cloudflare_page(), evaluated by wait_for_function.
+_CF_CLEAR_JS = """
+() => {
+  const t = (document.title || '').toLowerCase();
+  if (t.includes('just a moment') || t.includes('challenge')) return false;
+  if (document.querySelector("iframe[src*='challenges.cloudflare.com']")) return false;
+  if (document.querySelector('#challenge-stage, .cf-turnstile')) return false;
+  return true;
+}
+"""
+
+
 def wait_for_cf_clear(page, timeout_sec: int = 30) -> bool:
     """Passive wait — most stealth stacks auto-pass CF in a few seconds."""
     deadline = time.time() + timeout_sec
     while time.time() < deadline:
-        if not is_cloudflare_page(page):
+        remaining_ms = max(100, int((deadline - time.time()) * 1000))
+        try:
+            page.wait_for_function(_CF_CLEAR_JS, timeout=remaining_ms)
             return True
-        time.sleep(1)
+        except Exception:
+            # Auto-pass navigates the page, which can destroy the
+            # evaluation context mid-wait — re-check and re-arm.
+            if not is_cloudflare_page(page):
+                return True
+            time.sleep(0.5)
     return False
 
 
@@ -311,7 +372,7 @@ class LoginFlow:
     def run(self) -> bool:
         log("LOGIN", f"Navigating to portal {PORTAL_URL}")
         self.page.goto(PORTAL_URL, wait_until="domcontentloaded", timeout=NAV_TIMEOUT_MS)
-        time.sleep(CF_SETTLE_SEC)
+        cf_settle(self.page)
         handle_cloudflare(self.page)
         shot(self.page, "portal_landed")
 
@@ -408,16 +469,15 @@ class LoginFlow:
         except Exception:
             return False
 
+    # One comma-joined query instead of four sequential probes, each of
+    # which burned its own 1s is_visible timeout when absent.
+    LOGIN_BUTTON_SEL = (
+        "button.btn-danger:has-text('Login'), button:has-text('Login'), "
+        "a:has-text('Login'), button:has-text('Sign in')"
+    )
+
     def _has_login_button(self) -> bool:
-        for sel in [
-            "button.btn-danger:has-text('Login')",
-            "button:has-text('Login')",
-            "a:has-text('Login')",
-            "button:has-text('Sign in')",
-        ]:
-            if self._present(sel, timeout=1):
-                return True
-        return False
+        return self._present(self.LOGIN_BUTTON_SEL, timeout=1)
 
     # ── handlers ──
 
@@ -470,7 +530,6 @@ class LoginFlow:
         sel = "input[placeholder='someone@example.com'], input[name='loginfmt']"
         self.page.wait_for_selector(sel, state="visible", timeout=DEFAULT_TIMEOUT_MS)
         self.page.locator(sel).first.fill(self.email)
-        time.sleep(0.5)
         self._ms_submit()
         # Let MS finish AJAX transition to password page.
         try:
@@ -480,7 +539,6 @@ class LoginFlow:
             )
         except Exception:
             pass
-        time.sleep(3)
         shot(self.page, "ms_email_after")
 
     def _h_password(self) -> None:
@@ -490,15 +548,12 @@ class LoginFlow:
         self.page.wait_for_selector(sel, state="visible", timeout=DEFAULT_TIMEOUT_MS)
         loc = self.page.locator(sel).first
         loc.click()  # focus
-        loc.fill("")  # clear
-        loc.type(self.password, delay=30)
-        time.sleep(0.8)
+        loc.fill(self.password)
         self._ms_submit()
         try:
             self.page.wait_for_load_state("networkidle", timeout=15_000)
         except Exception:
             pass
-        time.sleep(3)
         shot(self.page, "ms_password_after")
 
     def _h_totp(self) -> None:
@@ -509,11 +564,8 @@ class LoginFlow:
         self.page.wait_for_selector(sel, state="visible", timeout=DEFAULT_TIMEOUT_MS)
         loc = self.page.locator(sel).first
         loc.click()
-        loc.fill("")
-        loc.type(code, delay=60)
-        time.sleep(0.5)
+        loc.fill(code)
         self._ms_submit()
-        time.sleep(4)
         shot(self.page, "ms_totp_after")
 
     def _h_stayloggedin(self) -> None:
@@ -562,11 +614,13 @@ class LoginFlow:
 
     def _h_ms_transition(self) -> None:
         log("LOGIN", "MS transitional — waiting…")
-        time.sleep(2)
+        time.sleep(0.5)  # floor: keep the state machine from spinning
+        self._settle()
 
     def _h_uowd_transition(self) -> None:
         log("LOGIN", "UOWD transitional — waiting…")
-        time.sleep(2)
+        time.sleep(0.5)
+        self._settle()
 
     def _h_unknown(self) -> None:
         self._unknown_count += 1
@@ -578,6 +632,13 @@ class LoginFlow:
         log("LOGIN", f"unknown page (retry {self._unknown_count}/5)")
         time.sleep(3)
 
+    def _settle(self, timeout_ms: int = 5_000) -> None:
+        """Wait for the post-click AJAX/navigation burst to quiet down."""
+        try:
+            self.page.wait_for_load_state("networkidle", timeout=timeout_ms)
+        except Exception:
+            pass
+
     def _ms_submit(self) -> None:
         for sel in [
             "input[type='submit']",
@@ -593,7 +654,7 @@ class LoginFlow:
                 loc = self.page.locator(sel).first
                 if loc.count() and loc.is_visible():
                     loc.click()
-                    time.sleep(3)
+                    self._settle()
                     return
             except Exception:
                 continue
@@ -602,13 +663,37 @@ class LoginFlow:
             self.page.keyboard.press("Enter")
         except Exception:
             pass
-        time.sleep(3)
+        self._settle()
 
 
 # ── Browser backends ─────────────────────────────────────────────────────────
 
 BACKENDS = ["camoufox", "patchright"]
 
+# Heavy resource types we never need for scraping. Stylesheets and scripts
+# stay enabled — the MS login flow and the Turnstile widget depend on them.
+_BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+# Hosts whose assets must load untouched; blocking anything here risks
+# breaking the Cloudflare challenge or SSO widgets.
+_ROUTE_ALLOW_HOSTS = ("challenges.cloudflare.com", MS_LOGIN_HOST, MS_LIVE_HOST)
+
+
+def _install_resource_blocking(ctx) -> None:
+    def _route(route):
+        req = route.request
+        if req.resource_type in _BLOCKED_RESOURCE_TYPES and not any(
+            host in req.url for host in _ROUTE_ALLOW_HOSTS
+        ):
+            route.abort()
+        else:
+            route.continue_()
+
+    try:
+        ctx.route("**/*", _route)
+    except Exception as exc:
+        log("BROWSER", f"resource blocking unavailable: {exc}", ok=False)
+
 
 @contextmanager
 def _camoufox_context(headless: bool, storage_state: Optional[str]) -> Iterator[Tuple[Any, Any]]:
@@ -627,6 +712,7 @@ def _camoufox_context(headless: bool, storage_state: Optional[str]) -> Iterator[
         ctx = browser.new_context(**kwargs)
         ctx.set_default_timeout(DEFAULT_TIMEOUT_MS)
         ctx.set_default_navigation_timeout(NAV_TIMEOUT_MS)
+        _install_resource_blocking(ctx)
         yield browser, ctx
 
 
@@ -649,6 +735,7 @@ def _patchright_context(headless: bool, storage_state: Optional[str]) -> Iterato
         ctx = browser.new_context(**kwargs)
         ctx.set_default_timeout(DEFAULT_TIMEOUT_MS)
         ctx.set_default_navigation_timeout(NAV_TIMEOUT_MS)
+        _install_resource_blocking(ctx)
         try:
             yield browser, ctx
         finally:
@@ -690,12 +777,34 @@ class Scraper:
         self.raw_output = raw_output
         self.debug_dump_raw = debug_dump_raw
         self.supabase = init_supabase()
-        self.room_map = fetch_room_mapping(self.supabase)
+        # Fetched lazily on first use: the room map is only needed once a
+        # scrape has succeeded, so failed browser runs skip the round-trip.
+        self._room_map: Optional[Dict[str, str]] = None
+        self._room_map_lengths: Tuple[int, ...] = ()
+
+    @property
+    def room_map(self) -> Dict[str, str]:
+        if self._room_map is None:
+            self._room_map = fetch_room_mapping(self.supabase)
+            self._room_map_lengths = shortcode_lengths(self._room_map)
+        return self._room_map
+
+    @property
+    def room_map_lengths(self) -> Tuple[int, ...]:
+        self.room_map  # ensure loaded
+        return self._room_map_lengths
 
     def run(self, output_path: Path) -> bool:
         t0 = time.time()
         last_err: Optional[str] = None
-        for backend in self.backends:
+        for attempt, backend in enumerate(self.backends):
+            if attempt:
+                # Brief jittered pause before the fallback backend — going
+                # straight back at Cloudflare after a failure tends to
+                # trip the same challenge again.
+                delay = random.uniform(0, min(BACKOFF_CAP_SEC, BACKOFF_BASE_SEC * (2 ** attempt)))
+                log("RUN", f"backing off {delay:.1f}s before {backend}")
+                time.sleep(delay)
             log("RUN", f"Backend: {backend}")
             try:
                 with open_backend(backend, self.headless, str(STORAGE_STATE_PATH) if not self.force_login else None) as (_browser, ctx):
@@ -723,7 +832,7 @@ class Scraper:
             log("SESSION", "restoring — trying direct viewer load")
             try:
                 page.goto(VIEWER_URL, wait_until="domcontentloaded", timeout=NAV_TIMEOUT_MS)
-                time.sleep(CF_SETTLE_SEC)
+                cf_settle(page)
                 handle_cloudflare(page)
                 if self._is_viewer_ready(page):
                     log("SESSION", "cached session works — skipped login.")
@@ -758,7 +867,7 @@ class Scraper:
         target = f"{VIEWER_URL}?semester={sem_id}"
         log("SCRAPE", f"loading {target}")
         page.goto(target, wait_until="domcontentloaded", timeout=NAV_TIMEOUT_MS)
-        time.sleep(3)
+        cf_settle(page, max_sec=3)
         handle_cloudflare(page)
 
         data = self._extract_json(page)
@@ -882,19 +991,37 @@ class Scraper:
         return None
 
     def _extract_json(self, page) -> Optional[List[Dict[str, Any]]]:
+        # The viewer already parsed timetableData into a JS array — pull it
+        # through the protocol directly instead of serializing the whole
+        # DOM and regex-scanning it. Fall back to the HTML scan if the
+        # variable is missing or the evaluation fails.
+        try:
+            data = page.evaluate(
+                "() => (typeof timetableData !== 'undefined') ? timetableData : null"
+            )
+            if isinstance(data, list) and data:
+                log("SCRAPE", f"parsed {len(data)} entries (in-page)")
+                return data
+        except Exception as exc:
+            log("SCRAPE", f"in-page eval failed: {_exc_label(exc)} — scanning HTML", ok=False)
         html = page.content()
-        match = re.search(r"timetableData\s*=\s*(\[.*?\])\s*;", html, re.DOTALL | re.MULTILINE)
+        match = TIMETABLE_RE.search(html)
         if not match:
             log("SCRAPE", "timetableData pattern not found", ok=False)
             return None
         try:
-            data = json.loads(match.group(1))
+            if orjson is not None:
+                data = orjson.loads(match.group(1))
+            else:
+                data = json.loads(match.group(1))
             log("SCRAPE", f"parsed {len(data)} entries")
             return data
-        except json.JSONDecodeError as exc:
+        except ValueError as exc:  # covers json.JSONDecodeError / orjson.JSONDecodeError
             log("SCRAPE", f"json err: {exc}", ok=False)
             return None
 
+    CSV_FIELDS = ["SubCode", "Class", "Day", "StartTime", "EndTime", "Room", "Teacher"]
+
     def _write_csv(self, data: List[Dict[str, Any]], path: Path) -> int:
         """
         Build rows in memory first; only overwrite the CSV if the new run
@@ -902,32 +1029,34 @@ class Scraper:
         incomplete run (e.g. 0 rows) would otherwise truncate the file.
         """
         required = {"subject_code", "location", "week_day", "start_time", "end_time"}
-        rows: List[Dict[str, str]] = []
+        room_map, room_map_lengths = self.room_map, self.room_map_lengths
+        rows: List[Tuple[str, ...]] = []
         for entry in data:
             if not all(entry.get(f) for f in required):
                 continue
+            # normalize_whitespace() already strips, so normalize first and
+            # filter on the result instead of scanning each part twice.
             locs = [
-                normalize_whitespace(l)
-                for l in entry.get("location", "").split(";")
-                if l.strip()
+                n for n in
+                (normalize_whitespace(l) for l in entry.get("location", "").split(";"))
+                if n
             ] or ["Unknown"]
             teachers = [
-                normalize_whitespace(t)
-                for t in entry.get("lecturer", "").split(";")
-                if t.strip()
+                n for n in
+                (normalize_whitespace(t) for t in entry.get("lecturer", "").split(";"))
+                if n
             ] or ["Unknown"]
+            # Entry-level fields are invariant across the loc×teacher
+            # expansion — normalize them once, not per emitted row.
+            sub_code   = entry.get("subject_code", "").replace(" ", "")
+            class_name = normalize_whitespace(entry.get("type_with_section", ""))
+            day        = normalize_whitespace(entry.get("week_day", ""))
+            start_time = format_time_hhmm(entry.get("start_time"))
+            end_time   = format_time_hhmm(entry.get("end_time"))
             for loc in locs:
-                room = resolve_room(loc, self.room_map)
+                room = resolve_room(loc, room_map, room_map_lengths)
                 for teacher in teachers:
-                    rows.append({
-                        "SubCode":   entry.get("subject_code", "").replace(" ", ""),
-                        "Class":     normalize_whitespace(entry.get("type_with_section", "")),
-                        "Day":       normalize_whitespace(entry.get("week_day", "")),
-                        "StartTime": format_time_hhmm(entry.get("start_time")),
-                        "EndTime":   format_time_hhmm(entry.get("end_time")),
-                        "Room":      room,
-                        "Teacher":   teacher,
-                    })
+                    rows.append((sub_code, class_name, day, start_time, end_time, room, teacher))
 
         if not rows:
             log("CSV", "0 rows — refusing to overwrite existing CSV", ok=False)
@@ -936,12 +1065,9 @@ class Scraper:
         path.parent.mkdir(parents=True, exist_ok=True)
         # Atomic replace via temp file in same dir.
         tmp = path.with_suffix(path.suffix + ".tmp")
-        with tmp.open("w", newline="", encoding="utf-8") as fh:
-            writer = csv.DictWriter(
-                fh,
-                fieldnames=["SubCode", "Class", "Day", "StartTime", "EndTime", "Room", "Teacher"],
-            )
-            writer.writeheader()
+        with tmp.open("w", newline="", encoding="utf-8", buffering=1 << 20) as fh:
+            writer = csv.writer(fh)
+            writer.writerow(self.CSV_FIELDS)
             writer.writerows(rows)
         tmp.replace(path)
         return len(rows)
@@ -983,7 +1109,7 @@ class Scraper:
     ]
 
     def _write_raw_csv(self, data: List[Dict[str, Any]], path: Path) -> int:
-        rows: List[Dict[str, str]] = []
+        rows: List[Tuple[str, ...]] = []
         for entry in data:
             if not (entry.get("subject_code") and entry.get("week_day")):
                 continue
@@ -995,20 +1121,21 @@ class Scraper:
             sem_id = entry.get("semester_id")
             sem_id_str = str(sem_id) if sem_id is not None else ""
 
-            rows.append({
-                "SubCode":         sub_code,
-                "SubName":         normalize_whitespace(entry.get("subject_name", "") or ""),
-                "Type":            normalize_whitespace(entry.get("type", "") or ""),
-                "TypeWithSection": normalize_whitespace(entry.get("type_with_section", "") or ""),
-                "TypeFull":        normalize_whitespace(entry.get("type_full", "") or ""),
-                "SelectionOption": normalize_whitespace(entry.get("subject_selection_option", "") or ""),
-                "Day":             normalize_whitespace(entry.get("week_day", "") or ""),
-                "StartTime":       format_time_hhmm(entry.get("start_time")),
-                "EndTime":         format_time_hhmm(entry.get("end_time")),
-                "Location":        normalize_whitespace(entry.get("location", "") or ""),
-                "Lecturer":        normalize_whitespace(entry.get("lecturer", "") or ""),
-                "SemesterId":      sem_id_str,
-            })
+            # Tuple order matches RAW_CSV_FIELDS.
+            rows.append((
+                sub_code,
+                normalize_whitespace(entry.get("subject_name", "") or ""),
+                normalize_whitespace(entry.get("type", "") or ""),
+                normalize_whitespace(entry.get("type_with_section", "") or ""),
+                normalize_whitespace(entry.get("type_full", "") or ""),
+                normalize_whitespace(entry.get("subject_selection_option", "") or ""),
+                normalize_whitespace(entry.get("week_day", "") or ""),
+                format_time_hhmm(entry.get("start_time")),
+                format_time_hhmm(entry.get("end_time")),
+                normalize_whitespace(entry.get("location", "") or ""),
+                normalize_whitespace(entry.get("lecturer", "") or ""),
+                sem_id_str,
+            ))
 
         if not rows:
             log("RAW", "0 rows — refusing to overwrite existing raw CSV", ok=False)
@@ -1016,13 +1143,9 @@ class Scraper:
 
         path.parent.mkdir(parents=True, exist_ok=True)
         tmp = path.with_suffix(path.suffix + ".tmp")
-        with tmp.open("w", newline="", encoding="utf-8") as fh:
-            writer = csv.DictWriter(
-                fh,
-                fieldnames=self.RAW_CSV_FIELDS,
-                quoting=csv.QUOTE_MINIMAL,
-            )
-            writer.writeheader()
+        with tmp.open("w", newline="", encoding="utf-8", buffering=1 << 20) as fh:
+            writer = csv.writer(fh, quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(self.RAW_CSV_FIELDS)
             writer.writerows(rows)
         tmp.replace(path)
         return len(rows)
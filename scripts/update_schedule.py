@@ -20,7 +20,12 @@ from pathlib import Path
 from typing import Dict, List, Optional
 
 from bs4 import BeautifulSoup
-from camoufox.sync_api import Camoufox
+
+try:
+    import lxml  # noqa: F401  (optional: much faster HTML parse)
+    SOUP_PARSER = "lxml"
+except ImportError:
+    SOUP_PARSER = "html.parser"
 
 CALENDAR_URL = "https://www.uowdubai.ac.ae/students/academic-calendar"
 FETCH_BACKENDS = ["camoufox", "patchright"]
@@ -61,6 +66,8 @@ def _load_calendar_page(page) -> str:
 
 
 def _fetch_with_camoufox() -> str:
+    from camoufox.sync_api import Camoufox
+
     log("FETCH", "backend=camoufox")
     with Camoufox(headless=True, humanize=True, geoip=True, i_know_what_im_doing=True) as br:
         ctx = br.new_context(locale="en-US")
@@ -162,7 +169,7 @@ def parse_last_date(text: str) -> Optional[datetime.date]:
 
 def parse_semesters(html: str) -> List[Dict]:
     """Return list of {name, peak_start (iso), peak_end (iso)} entries."""
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, SOUP_PARSER)
     tabs = soup.select("ul.tab-container a.nav-link")
     # Panels have ids tab1..tab4 and their labels come from the tab anchors.
     labels = {}